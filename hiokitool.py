@@ -1,10 +1,14 @@
 # Copyright (c) 2024 4x0
 # Licensed under the MIT License - see LICENSE file for details
 
+import asyncio
+import itertools
+import selectors
 import socket
 import time
 import configparser
-from datetime import datetime, timedelta
+import functools
+from datetime import datetime
 from time import sleep
 import argparse
 import re
@@ -15,42 +19,82 @@ import sys
 
 class MessageQueue:
     def __init__(self):
-        self.queue = {'wait': True, 'items': []}
+        self._wait = True  # Whether the next send reads a reply
+        self._parts = []  # Encoded commands with their ';' separators, in wire order
+        self._count = 0
     @property
     def size(self):
-        return len(self.queue['items'])
+        return self._count
     def put(self, item, wait=True):
-        if wait or self.size == 0:
-            self.set_wait(wait)
-        self.queue['items'].append(item)
+        if wait or not self._count:
+            self._wait = wait
+        if self._count:
+            self._parts.append(b';')
+        self._parts.append(item.encode('utf-8'))
+        self._count += 1
     def get(self):
-        return ';'.join(self.queue['items'])
+        return b''.join(self._parts).decode('utf-8')
+    def get_parts(self):
+        """The queued commands and the CR+LF terminator as separate buffers, for a gathering send"""
+        return self._parts + [b'\r\n']
     def wait(self):
-        return self.queue['wait']
+        return self._wait
     def set_wait(self, do_wait):
-        self.queue['wait'] = do_wait
+        self._wait = do_wait
     def clear(self):
-        self.queue['items'] = []
-        self.queue['wait'] = True
+        self._parts = []
+        self._count = 0
+        self._wait = True
 
+BUFSIZE = 65536
+MAX_RESPONSE_SIZE = 1024 * 1024  # 1MB max response size
+CSV_BATCH = 64  # CSV rows joined into a single write
+FLUSH_INTERVAL = 10  # Seconds of rows held back at most by the default flush_every, and between progress lines
+BURST_CHUNK = 50  # Readings per :READ? of a burst, bounds the wait for one reply to BURST_CHUNK timeouts
+_TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)  # Linux only, looked up once as it is set after every recv
+_DATE_MASK_RE = re.compile(r'(?:%.){1,4}')  # strftime mask in label text, e.g. %H%M
+_QUOTED_RE = re.compile(r'"[^"]*"')  # String parameters, e.g. label text
 
-Q = MessageQueue()
-BUFSIZE = 4096
+
+def _is_query(command):
+    """True if any command of a ';' chain is a query, i.e. has '?' in its header. Parameters don't count"""
+    for part in _QUOTED_RE.sub('', command).split(';'):
+        header = part.split(None, 1)
+        if header and '?' in header[0]:
+            return True
+    return False
 
 
 class TelnetClient:
-    def __init__(self, host, port=23, timeout=10):
+    def __init__(self, host, port=23, timeout=10, sndbuf=0, rcvbuf=0, verbose=False):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.verbose = verbose  # Echo every command sent
+        self.sndbuf = sndbuf  # Kernel socket buffer sizes, 0 keeps the system default and autotuning
+        self.rcvbuf = rcvbuf
         self.sock = None
+        # Receive buffer reused for every response, _rxlen bytes of it are filled
+        self._rxbuf = bytearray(BUFSIZE)
+        self._rxview = memoryview(self._rxbuf)
+        self._rxlen = 0
+        self._sel = None  # Selector (an epoll fd on Linux) of the open connection
+        self.q = MessageQueue()  # Commands waiting for the next send_query()
 
     def connect(self):
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
             self.sock.settimeout(self.timeout)
+            self._set_buffers()
+            self._set_keepalive()
             self.sock.connect((self.host, self.port))
+            # From here on the socket is non-blocking, waits go through the selector with an overall deadline
+            self.sock.setblocking(False)
+            self._sel = selectors.DefaultSelector()
+            self._sel.register(self.sock, selectors.EVENT_READ)
+            self._quickack()
+            self._rxlen = 0
         except socket.timeout:
             raise ConnectionError(f"Connection timeout to {self.host}:{self.port} after {self.timeout} seconds")
         except socket.gaierror as e:
@@ -60,106 +104,351 @@ class TelnetClient:
         except Exception as e:
             raise ConnectionError(f"Failed to connect to {self.host}:{self.port}. Error: {e}")
 
+    def reconnect(self):
+        """Tear down and re-open the connection, e.g. after the instrument dropped it"""
+        self.close()
+        self.q.clear()
+        self.connect()
+
+    def __enter__(self):
+        if self.sock is None:
+            self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def begin_batch(self):
+        """Hold back partial segments until end_batch(), so back-to-back writes go out as full packets (Linux)"""
+        if hasattr(socket, 'TCP_CORK') and self.sock:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    def end_batch(self):
+        """Push out anything held back by begin_batch(), must come before a query that waits for its reply"""
+        if hasattr(socket, 'TCP_CORK') and self.sock:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    def _set_buffers(self):
+        # Must be set before connect() so the TCP window scale is negotiated for them
+        for opt, name, size in ((socket.SO_SNDBUF, 'SO_SNDBUF', self.sndbuf),
+                                (socket.SO_RCVBUF, 'SO_RCVBUF', self.rcvbuf)):
+            if not size:
+                continue
+            self.sock.setsockopt(socket.SOL_SOCKET, opt, size)
+            actual = self.sock.getsockopt(socket.SOL_SOCKET, opt)
+            if actual < size:
+                print(f"Warning: {name} limited to {actual} bytes by the kernel (requested {size}, "
+                      f"see net.core.wmem_max/rmem_max)")
+
+    def _quickack(self):
+        # Acknowledge replies immediately instead of holding the ACK back for up to 40 ms (Linux).
+        # The kernel drops back to delayed ACKs on its own, so this is re-armed after every recv.
+        if _TCP_QUICKACK is not None:
+            self.sock.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+
+    def _set_keepalive(self):
+        # Detect a rebooted or unplugged instrument instead of keeping a dead socket open
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, name):  # Linux only
+                self.sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
     def send_command(self, command):
         if self.sock is None:
             raise RuntimeError("Not connected to any server.")
         try:
-            command = command + '\r\n'  # Add a terminator, CR+LF, to transmitted command
-            self.sock.send(bytes(command, 'utf-8'))  # Convert to byte type and send
+            self._sendall(command.encode('utf-8') + b'\r\n')  # Add a terminator, CR+LF, to transmitted command
             response = self._receive_response(self.timeout)
             return response
         except socket.timeout:
             raise TimeoutError(f"Timeout waiting for response to command: {command.strip()}")
-        except BrokenPipeError:
+        except ConnectionError:  # Broken pipe, reset or closed by the instrument
             raise ConnectionError("Connection lost while sending command")
         except Exception as e:
             raise RuntimeError(f"Failed to send command '{command.strip()}'. Error: {e}")
 
+    def enqueue(self, command, wait=None):
+        """Queue a command for the next send_query(), by default queries wait for a reply"""
+        self.q.put(command, _is_query(command) if wait is None else wait)
+        return command
+
+    def flush(self):
+        """Send the queued commands, if there are any"""
+        if self.q.size:
+            return self.send_query()
+        return None
+
     def send_query(self):
         if self.sock is None:
             raise RuntimeError("Not connected to any server.")
         try:
-            command = Q.get() + '\r\n'  # Add a terminator, CR+LF, to transmitted command
-            print(command.strip())
-            self.sock.send(bytes(command, 'utf-8'))  # Convert to byte type and send
-            if Q.wait():
+            if self.verbose:
+                print(self.q.get())  # Joined and decoded only for the echo, the socket gets the encoded parts
+            self.sendall_iov(self.q.get_parts())
+            if self.q.wait():
                 response = self._receive_response(self.timeout)
             else:
                 response = True
-            Q.clear()
+            self.q.clear()
             return response
         except socket.timeout:
-            raise TimeoutError(f"Timeout waiting for response to query: {command.strip()}")
-        except BrokenPipeError:
+            raise TimeoutError(f"Timeout waiting for response to query: {self.q.get()}")
+        except ConnectionError:  # Broken pipe, reset or closed by the instrument
+            raise ConnectionError("Connection lost while sending query")
+        except Exception as e:
+            raise RuntimeError(f"Failed to send query. Error: {e}")
+
+    def sendall_iov(self, parts):
+        """Send a list of byte strings with a single gathering sendmsg() where the platform has it"""
+        if not hasattr(self.sock, 'sendmsg') or len(parts) > 1024:  # Windows, or more than IOV_MAX buffers
+            self._sendall(b''.join(parts))
+            return
+        try:
+            sent = self.sock.sendmsg(parts)
+        except BlockingIOError:
+            sent = 0
+        total = sum(len(p) for p in parts)
+        if sent < total:  # Short write, send the remainder in one piece
+            self._sendall(b''.join(parts)[sent:])
+
+    def write(self, command, expect_reply=None, timeout=None):
+        """Send a single command right away, bypassing the message queue. Returns the reply, or True for settings"""
+        if self.verbose:
+            print(command)
+        if expect_reply is None:
+            expect_reply = _is_query(command)
+        return self.send_raw(command.encode('utf-8') + b'\r\n', expect_reply, timeout)
+
+    def send_raw(self, frame, expect_reply=True, timeout=None):
+        """Fast path for a pre-encoded, CR+LF terminated command, bypassing the message queue"""
+        if self.sock is None:
+            raise RuntimeError("Not connected to any server.")
+        try:
+            self._sendall(frame)
+            if not expect_reply:
+                return True
+            return self._receive_response(timeout or self.timeout)
+        except socket.timeout:
+            raise TimeoutError(f"Timeout waiting for response to query: {frame.strip().decode('utf-8')}")
+        except ConnectionError:  # Broken pipe, reset or closed by the instrument
             raise ConnectionError("Connection lost while sending query")
         except Exception as e:
             raise RuntimeError(f"Failed to send query. Error: {e}")
 
+    def send_batch(self, commands):
+        """Send a list of commands chained in a single write, returns the values of the ';'-joined reply"""
+        response = self.write(';'.join(commands))
+        return [] if response is True else response.split(';')
+
+    def _sendall(self, data):
+        # Loop until the whole message is written, send() may return after a partial write
+        view = memoryview(data)
+        deadline = time.monotonic() + self.timeout
+        while view:
+            try:
+                view = view[self.sock.send(view):]
+            except BlockingIOError:
+                self._wait(selectors.EVENT_WRITE, deadline)
+
+    def _wait(self, events, deadline):
+        """Block until the socket is ready for events, raise socket.timeout once deadline has passed"""
+        if events != selectors.EVENT_READ:
+            self._sel.modify(self.sock, events)
+        try:
+            ready = self._sel.select(max(0.0, deadline - time.monotonic()))
+        finally:
+            if events != selectors.EVENT_READ:
+                self._sel.modify(self.sock, selectors.EVENT_READ)
+        if not ready:
+            raise socket.timeout()
+
     def _receive_response(self, timeout):
-        msgBuf = bytes()  # Received Data
-        MAX_RESPONSE_SIZE = 1024 * 1024  # 1MB max response size
+        """Read one LF-terminated reply within timeout"""
+        deadline = time.monotonic() + timeout  # For the whole response, not per recv
         try:
-            start = time.time()  # Record time for timeout
+            scan = 0
             while True:
-                rcv = self.sock.recv(BUFSIZE)
-                rcv = rcv.strip(b"\r")  # Delete CR in received data
-                if b"\n" in rcv:  # End the loop when LF is received
-                    rcv = rcv.strip(b"\n")  # Ignore the terminator CR
-                    msgBuf += rcv
-                    msgBuf = msgBuf.decode('utf-8')
-                    break
-                else:
-                    msgBuf += rcv
-                    # Check for buffer overflow
-                    if len(msgBuf) > MAX_RESPONSE_SIZE:
+                end = self._rxbuf.find(b"\n", scan, self._rxlen)  # End when LF is received
+                if end >= 0:
+                    # Ignore the terminator CR and decode straight from the buffer, no intermediate bytes copy
+                    stop = end - 1 if end and self._rxbuf[end - 1] == 0x0D else end
+                    try:
+                        return str(self._rxview[:stop], 'utf-8')
+                    finally:
+                        # Keep anything received after the terminator for the next response
+                        rest = self._rxlen - end - 1
+                        if rest:  # Usually nothing follows the terminator
+                            self._rxbuf[:rest] = self._rxbuf[end + 1:self._rxlen]
+                        self._rxlen = rest
+                scan = self._rxlen
+                if len(self._rxbuf) - self._rxlen < BUFSIZE // 4:  # Grow early so a recv never gets just a sliver
+                    if self._rxlen >= MAX_RESPONSE_SIZE:
                         raise RuntimeError(f"Response exceeded maximum size of {MAX_RESPONSE_SIZE} bytes")
-                # Timeout processing
-                if time.time() - start > timeout:
-                    msgBuf = "Timeout Error"
-                    break
+                    self._grow_rxbuf()
+                self._wait(selectors.EVENT_READ, deadline)
+                # Short replies (readings, *IDN?) arrive in a single recv into the free space of the buffer
+                rcv = self.sock.recv_into(self._rxview[self._rxlen:])
+                if not rcv:
+                    raise ConnectionError("Connection closed while waiting for response")
+                self._rxlen += rcv
+                self._quickack()
         except UnicodeDecodeError as e:
             raise RuntimeError(f"Failed to decode response. Invalid UTF-8 data: {e}")
+        except (socket.timeout, ConnectionError):
+            raise  # Reported by the caller together with the command
         except Exception as e:
             if isinstance(e, RuntimeError):
                 raise
             raise RuntimeError(f"Failed to receive response. Error: {e}")
-        return msgBuf
+
+    def _grow_rxbuf(self):
+        # A bytearray can't be resized while a memoryview of it exists
+        self._rxview.release()
+        self._rxbuf.extend(bytes(len(self._rxbuf)))
+        self._rxview = memoryview(self._rxbuf)
 
     def close(self):
+        if self._sel is not None:
+            self._sel.close()  # Closes its fd right away instead of leaving it to the garbage collector
+            self._sel = None
         if self.sock:
             self.sock.close()
             self.sock = None
 
 
+def map_replies(commands, values):
+    """Pair the values of a chained reply with the queries among the chained commands, settings map to True"""
+    queries = [c for c in commands if _is_query(c)]
+    if len(values) != len(queries):
+        raise RuntimeError(f"Expected {len(queries)} values in response, got {len(values)}: {';'.join(values)}")
+    data = dict.fromkeys(commands, True)  # Settings produce no reply
+    data.update(zip(queries, (v.strip() for v in values)))
+    return data
+
+
+class AsyncTelnetClient:
+    """asyncio counterpart of TelnetClient, for driving instruments from an event loop"""
+    def __init__(self, host, port=23, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, limit=BUFSIZE), self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Connection timeout to {self.host}:{self.port} after {self.timeout} seconds")
+        except socket.gaierror as e:
+            raise ConnectionError(f"Failed to resolve host {self.host}: {e}")
+        except ConnectionRefusedError:
+            raise ConnectionError(f"Connection refused by {self.host}:{self.port}. Check if instrument is powered on and network settings are correct")
+        except Exception as e:
+            raise ConnectionError(f"Failed to connect to {self.host}:{self.port}. Error: {e}")
+
+    async def send(self, command):
+        """Send a command that produces no reply"""
+        if self.writer is None:
+            raise RuntimeError("Not connected to any server.")
+        self.writer.write(command.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+
+    async def query(self, command):
+        """Send a query and wait for its reply"""
+        await self.send(command)
+        return await self._read_reply(command)
+
+    async def pipeline(self, queries, depth=16):
+        """Send queries without waiting for each reply, with up to depth of them outstanding.
+        The instrument answers in order, so the replies are returned in the order of queries."""
+        window = asyncio.Semaphore(depth)
+
+        async def send_all():
+            for command in queries:
+                await window.acquire()
+                await self.send(command)
+
+        sender = asyncio.ensure_future(send_all())
+        replies = []
+        try:
+            for command in queries:
+                replies.append(await self._read_reply(command))
+                window.release()
+            await sender  # Surface errors from the sending side
+        finally:
+            sender.cancel()
+        return replies
+
+    async def _read_reply(self, command):
+        try:
+            line = await asyncio.wait_for(self.reader.readuntil(b'\n'), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timeout waiting for response to query: {command}")
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed while waiting for response")
+        return line.rstrip(b'\r\n').decode('utf-8')
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = self.writer = None
+
+
+def run_async(coro):
+    """Run a coroutine to completion, on uvloop when it is installed"""
+    try:
+        import uvloop
+        loop = uvloop.new_event_loop()
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 class ControlQuery:
     def __init__(self, stub):
         self.stub = stub
+        self._qstr = f'{stub}?'  # The query never changes, build it once
+        self._frames = {}  # Encoded, terminated queries for send_raw(), by sub
     def get(self, sub=None):
-        m = f'{self.stub}? {sub}' if sub is not None else f'{self.stub}?'
-        Q.put(m, True)
-        return m
+        return self._qstr if sub is None else f'{self._qstr} {sub}'
+    def frame(self, sub=None):
+        """The query as CR+LF terminated bytes, encoded on first use"""
+        frame = self._frames.get(sub)
+        if frame is None:
+            frame = self._frames[sub] = (self.get(sub) + '\r\n').encode('ascii')
+        return frame
     def __repr__(self):
-        return self.get()
+        # Must not call get(), that would queue a command as a side effect
+        return f'<{type(self).__name__} {self.stub}>'
     def __str__(self):
-        return self.get()
+        return self.__repr__()
 
 
 class Control(ControlQuery):
+    def __init__(self, stub):
+        super().__init__(stub)
+        self._set_prefix = f'{stub} '.encode('ascii')  # Encoded once for set_frame()
     def set(self, value):
-        m = f'{self.stub} {value}'
-        Q.put(m, False)
-        return m
+        return f'{self.stub} {value}'
+    def set_frame(self, value):
+        """set() as CR+LF terminated bytes for send_raw()"""
+        return self._set_prefix + str(value).encode('ascii') + b'\r\n'
 
     def __call__(self, value):
         print(value)
-        self.set(value)
+        return self.set(value)
 
 
 class ControlSetting(ControlQuery):
-    def get(self):
-        m = f'{self.stub}'
-        Q.put(m, False)
-        return m
+    def get(self, sub=None):
+        # Same signature as ControlQuery.get(), so the inherited frame() works
+        return self.stub if sub is None else f'{self.stub} {sub}'
 
 
 class System:
@@ -172,6 +461,9 @@ class System:
         self.time = Control(':SYSTem:TIME')  # <Hour 00 to 23>,<Minute>,<Second; 00 to 59>
         self.wait = ControlSetting('*WAI')
 
+    def status(self):
+        return ';'.join([self.device_id.get(), self.installed_options.get()])
+
 
 class Display:
     def __init__(self):
@@ -217,23 +509,30 @@ class Measure:
         self.immediate = ControlSetting(':INITiate:IMMediate')
         self.abort = ControlSetting(':ABORt')
 
+    def status(self):
+        return ';'.join([self.sample_count.get(), self.voltage_range.get(), self.voltage_range_auto.get(),
+                         self.dc_voltage.get(), self.format.get(), self.apeture_control.get(),
+                         self.apeture_time.get(), self.impedence_auto.get(), self.voltage_digits.get(),
+                         self.trigger_delay.get(), self.trigger_delay_auto.get()])
+
 
 class ExternalIO:
     def __init__(self):
         self.mode = ControlQuery(':IO:MODE')
         self.input = ControlQuery(':IO:INPut')
-        self.output = ControlSetting(':IO:OUTPut')  # <Output data 0 to 2047>
+        self.output = Control(':IO:OUTPut')  # <Output data 0 to 2047>
 
 
 class IOSequencer:
     """Handles sequential IO output patterns during measurements"""
+    __slots__ = ('enabled', 'mode', 'patterns', 'current', 'samples_per_step', 'loop', 'include_in_csv', '_iter')
+
     def __init__(self, config):
         self.enabled = False
         self.mode = 'range'  # 'range' or 'list'
-        self.patterns = []
-        self.current_index = 0
+        self.patterns = ()
+        self.current = None
         self.samples_per_step = 1
-        self.samples_at_current = 0
         self.loop = False
         self.include_in_csv = False
         
@@ -241,20 +540,20 @@ class IOSequencer:
             return
             
         seq_config = config['IO.Sequence']
-        self.enabled = seq_config.get('enabled', 'false').upper() == 'TRUE'
+        self.enabled = seq_config.getboolean('enabled', fallback=False)
         
         if not self.enabled:
             return
             
         self.mode = seq_config.get('mode', 'range').lower()
-        self.samples_per_step = int(seq_config.get('samples_per_step', '1'))
-        self.loop = seq_config.get('loop', 'true').upper() == 'TRUE'
-        self.include_in_csv = seq_config.get('include_io_in_csv', 'true').upper() == 'TRUE'
+        self.samples_per_step = max(1, seq_config.getint('samples_per_step', fallback=1))
+        self.loop = seq_config.getboolean('loop', fallback=True)
+        self.include_in_csv = seq_config.getboolean('include_io_in_csv', fallback=True)
         
         if self.mode == 'range':
-            start = int(seq_config.get('start', '0'))
-            end = int(seq_config.get('end', '7'))
-            step = int(seq_config.get('step', '1'))
+            start = seq_config.getint('start', fallback=0)
+            end = seq_config.getint('end', fallback=7)
+            step = seq_config.getint('step', fallback=1)
             
             # Validate range
             if start < 0 or start > 2047:
@@ -286,47 +585,35 @@ class IOSequencer:
         if not self.patterns:
             self.patterns = [0]  # Default to single pattern
     
-    def should_change(self):
-        """Check if it's time to change IO output"""
-        if not self.enabled or not self.patterns:
-            return False
-        return self.samples_at_current >= self.samples_per_step
+        self.patterns = tuple(self.patterns)
+        # Walk the patterns with an iterator instead of index bookkeeping on every sample
+        self._iter = itertools.cycle(self.patterns) if self.loop else iter(self.patterns)
+        self.current = next(self._iter)
     
-    def next(self):
-        """Move to next IO pattern"""
-        if not self.enabled:
-            return None
-            
-        self.samples_at_current = 0
-        self.current_index += 1
-        
-        if self.current_index >= len(self.patterns):
-            if self.loop:
-                self.current_index = 0
-            else:
-                self.enabled = False  # Disable after one complete cycle
-                return None
-                
-        return self.get_current()
+    def advance(self):
+        """Move to the next IO pattern and return it, None once a non-looping sequence is done"""
+        self.current = next(self._iter, None)
+        return self.current
     
     def get_current(self):
         """Get current IO output value"""
-        if not self.enabled or not self.patterns:
+        if not self.enabled:
             return None
-        if self.current_index < len(self.patterns):
-            return self.patterns[self.current_index]
-        return None
-    
-    def increment_sample(self):
-        """Increment sample counter for current IO state"""
-        if self.enabled:
-            self.samples_at_current += 1
-    
-    def is_complete(self):
-        """Check if sequence is complete (for non-looping mode)"""
-        if not self.enabled or self.loop:
-            return False
-        return self.current_index >= len(self.patterns)
+        return self.current
+
+
+class Timestamp:
+    """Wall-clock timestamps for the CSV output, the date and time part is only formatted once per second"""
+    def __init__(self):
+        self._sec = None
+        self._prefix = ''
+
+    def now(self):
+        sec, us = divmod(time.time_ns() // 1000, 1_000_000)
+        if sec != self._sec:
+            self._prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+            self._sec = sec
+        return f'{self._prefix}.{us:06d}'
 
 
 class Panel:
@@ -339,6 +626,11 @@ class Panel:
         return self.save_panel.set(panel_no)
 
 
+_RANGE_NAMES = ('100MV', '1V', '10V', '100V', '1000V', 'AUTO', 'MAX', 'MIN', 'DEFAULT')  # In the order shown in errors
+_VALID_RANGES = frozenset(_RANGE_NAMES)
+_VALID_SPEEDS = frozenset({'SLOW', 'MEDIUM', 'MED', 'FAST'})
+
+
 class RestrictedAPI:
     """Safe API for user scripts - prevents dangerous operations"""
     
@@ -365,10 +657,10 @@ class RestrictedAPI:
         if not 0 <= value <= 2047:
             raise ValueError(f"IO value {value} out of range (0-2047)")
         
-        Q.put(f':IO:OUTPut {value}', False)
-        self.conn.send_query()
+        self.conn.write(EXTERNAL_IO.output.set(value))
         self.current_io = value
-        print(f"IO set to: {value} (0b{value:011b})")
+        if self.conn.verbose:  # Confirmations are only shown with -v, like the command echo
+            print(f"IO set to: {value} (0b{value:011b})")
         return True
     
     def measure(self, samples=1, delay_ms=0):
@@ -376,18 +668,16 @@ class RestrictedAPI:
         if samples < 1 or samples > 5000:
             raise ValueError(f"Sample count {samples} out of range (1-5000)")
         
+        if not delay_ms and samples > 1:
+            return self._measure_burst(samples)
+        
         results = []
         for i in range(samples):
-            self.measure_obj.read.get()
-            result_str = self.conn.send_query()
+            result_str = self.conn.write(self.measure_obj.read.get())
             
             try:
-                # Handle both single values and comma-separated (voltage,temperature)
-                if ',' in result_str:
-                    values = [float(v.strip()) for v in result_str.split(',')]
-                    results.append(values[0])  # Primary measurement
-                else:
-                    results.append(float(result_str.strip()))
+                # Handle both single values and comma-separated (voltage,temperature), float() ignores whitespace
+                results.append(float(result_str.partition(',')[0]))  # Primary measurement
             except ValueError:
                 print(f"Warning: Could not parse measurement: {result_str}")
                 results.append(None)
@@ -395,38 +685,71 @@ class RestrictedAPI:
             if delay_ms > 0 and i < samples - 1:
                 sleep(delay_ms / 1000.0)
         
-        self.results.extend([r for r in results if r is not None])
+        self.results.extend(r for r in results if r is not None)
+        return results
+    
+    def _measure_burst(self, samples):
+        """Take the samples with a :READ? per BURST_CHUNK readings by setting the instrument's sample count,
+        then restore the previous count"""
+        sample_count = self.measure_obj.sample_count
+        read = self.measure_obj.read.get()
+        previous = self.conn.write(sample_count.get()).strip()  # E.g. [Measure] sample_count from the config
+        replies = []
+        try:
+            for start in range(0, samples, BURST_CHUNK):
+                n = min(BURST_CHUNK, samples - start)
+                # Every reading gets the full timeout, as separate reads would have
+                replies.append(self.conn.write(f'{sample_count.set(n)};{read}', timeout=self.conn.timeout * n))
+        except TimeoutError:
+            # The late reply would be taken as the answer to the next query, start over on a fresh connection
+            self.conn.reconnect()
+            self.conn.write(sample_count.set(previous))
+            raise
+        self.conn.write(sample_count.set(previous))
+        result_str = ','.join(replies)
+        
+        try:
+            results = list(map(float, result_str.split(',')))
+            self.results.extend(results)  # All parsed, nothing to filter
+        except ValueError:
+            results = []
+            for v in result_str.split(','):
+                try:
+                    results.append(float(v))
+                except ValueError:
+                    print(f"Warning: Could not parse measurement: {v}")
+                    results.append(None)
+            self.results.extend(r for r in results if r is not None)
+        if len(results) != samples:
+            print(f"Warning: Expected {samples} measurements, got {len(results)}")
+        
         return results
     
     def set_range(self, range_value):
         """Set voltage measurement range"""
-        valid_ranges = ['100MV', '1V', '10V', '100V', '1000V', 'AUTO', 'MAX', 'MIN', 'DEFAULT']
-        
         range_upper = str(range_value).upper()
-        if range_upper not in valid_ranges:
-            raise ValueError(f"Invalid range: {range_value}. Valid: {', '.join(valid_ranges)}")
+        if range_upper not in _VALID_RANGES:
+            raise ValueError(f"Invalid range: {range_value}. Valid: {', '.join(_RANGE_NAMES)}")
         
-        self.measure_obj.voltage_range.set(range_value)
-        self.conn.send_query()
+        self.conn.write(self.measure_obj.voltage_range.set(range_value))
         self.current_range = range_value
-        print(f"Range set to: {range_value}")
+        if self.conn.verbose:
+            print(f"Range set to: {range_value}")
         return True
     
     def set_speed(self, speed):
         """Set measurement speed (SLOW/MEDium/FAST)"""
-        valid_speeds = ['SLOW', 'MEDIUM', 'MED', 'FAST']
-        
         speed_upper = str(speed).upper()
-        if speed_upper not in valid_speeds:
+        if speed_upper not in _VALID_SPEEDS:
             raise ValueError(f"Invalid speed: {speed}. Valid: SLOW, MEDium, FAST")
         
         # Normalize MEDium/MED
         if speed_upper == 'MEDIUM':
             speed_upper = 'MED'
         
-        self.measure_obj.speed.set(speed_upper)
-        self.conn.send_query()
-        print(f"Speed set to: {speed_upper}")
+        self.conn.write(self.measure_obj.speed.set(speed_upper))
+        if self.conn.verbose:
+            print(f"Speed set to: {speed_upper}")
         return True
     
     def wait(self, seconds):
@@ -447,13 +770,25 @@ class RestrictedAPI:
                 'count': 0
             }
         
-        import statistics
+        # Single pass (Welford), instead of one walk over the results for each figure
+        n = 0
+        mean = m2 = 0.0
+        lo = hi = self.results[0]
+        for x in self.results:
+            n += 1
+            d = x - mean
+            mean += d / n
+            m2 += d * (x - mean)
+            if x < lo:
+                lo = x
+            elif x > hi:
+                hi = x
         return {
-            'mean': statistics.mean(self.results),
-            'max': max(self.results),
-            'min': min(self.results),
-            'std': statistics.stdev(self.results) if len(self.results) > 1 else 0,
-            'count': len(self.results)
+            'mean': mean,
+            'max': hi,
+            'min': lo,
+            'std': (m2 / (n - 1)) ** 0.5 if n > 1 else 0,
+            'count': n
         }
     
     def log(self, message):
@@ -487,15 +822,13 @@ class RestrictedAPI:
         if not filename.endswith('.csv'):
             filename += '.csv'
         
+        # Metadata, header and results go out in a single write
+        lines = [f"# {key}: {value}" for key, value in self.metadata.items()]
+        lines.append("# index,value")
+        lines.extend(f"{i},{value}" for i, value in enumerate(self.results))
+        lines.append('')
         with open(filename, 'w') as f:
-            # Write metadata
-            for key, value in self.metadata.items():
-                f.write(f"# {key}: {value}\n")
-            
-            # Write results
-            f.write("# index,value\n")
-            for i, value in enumerate(self.results):
-                f.write(f"{i},{value}\n")
+            f.write('\n'.join(lines))
         
         print(f"Results saved to: {filename}")
         return filename
@@ -506,122 +839,139 @@ class Label:
         self.label = Control(':SYSTem:LABel')
         self.label_state = Control(':SYSTem:LABel:STATe')
     def turn_on(self):
-        self.label_state.set('ON')
+        return self.label_state.set('ON')
     def turn_off(self):
-        self.label_state.set('OFF')
+        return self.label_state.set('OFF')
     def set_text(self, text):
-        self.turn_on()
-        date_re = re.compile(r'(?:\%.){0,4}')
         _text = text[:8].strip()
-        try:
-            dt_mask = [x for x in date_re.findall(_text) if x].pop()
-            # print(dt_mask)
-            dt_text = datetime.now().strftime(dt_mask)
-            print(dt_text)
-            _text = _text.replace(dt_mask, dt_text)
-            print(_text)
-        except IndexError:
-            pass
-        self.label.set('"%s"' % _text)
-
+        m = _DATE_MASK_RE.search(_text)
+        if m:
+            dt_text = datetime.now().strftime(m.group())
+            _text = _text[:m.start()] + dt_text + _text[m.end():]  # Splice at the match, no second scan
+        return ';'.join([self.turn_on(), self.label.set('"%s"' % _text)])
+
+
+# The controls only hold their command strings, so one shared instance of each is enough
+SYSTEM = System()
+DISPLAY = Display()
+MEASURE = Measure()
+PANEL = Panel()
+LABEL = Label()
+EXTERNAL_IO = ExternalIO()
+
+
+def _one_of(*choices):
+    """Config validator: the value upper-cased if it is one of choices, otherwise None so the key is skipped"""
+    choices = frozenset(choices)
+    def check(value):
+        value = value.upper()
+        return value if value in choices else None
+    return check
+
+def _trigger_delay(value):
+    try:
+        delay = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid float value for [Trigger] delay: {value}")
+    if not 0 <= delay <= 9.999:
+        raise ValueError(f"Trigger delay {delay} out of range (0-9.999 seconds)")
+    return delay
+
+
+BIT_KEYS = tuple(f'bit_{i}' for i in range(11))  # [IO] keys for the individual output bits, bit_0 first
+_TRUTHY = frozenset(k for k, v in configparser.ConfigParser.BOOLEAN_STATES.items() if v)  # Same words as cfg_get(..., bool)
+
+
+def _truthy(value):
+    """True for on/1/true/yes in any case, missing or anything else is False"""
+    return (value or '').strip().lower() in _TRUTHY
+
+
+# (section, key, control, validator) applied in this order by apply_config(). The validator returns the value
+# to send or None to skip the key, keys without one are passed to the instrument as-is.
+_CONFIG_MAP = (
+    ('Display', 'brightness', DISPLAY.brightness, None),
+    ('Display', 'view', DISPLAY.view, None),
+    ('Display', 'state', DISPLAY.state, None),
+    ('Display', 'type', DISPLAY.type, None),
+    ('Trigger', 'source', MEASURE.trigger_source, _one_of('IMMEDIATE', 'EXTERNAL', 'BUS')),
+    ('Trigger', 'delay', MEASURE.trigger_delay, _trigger_delay),
+    ('Trigger', 'delay_auto', MEASURE.trigger_delay_auto, _one_of('ON', 'OFF', '1', '0')),
+    ('Measure', 'voltage_range', MEASURE.voltage_range, None),
+    ('Measure', 'voltage_range_auto', MEASURE.voltage_range_auto, None),
+    ('Measure', 'speed', MEASURE.speed, None),
+    ('Measure', 'sample_count', MEASURE.sample_count, None),
+    ('Measure', 'format', MEASURE.format, None),
+    ('Measure', 'continuous', MEASURE.continuous, None),
+    ('Measure', 'impedence_auto', MEASURE.impedence_auto, None),
+)
+
+
+def setup_commands():
+    """Queries that read back the whole instrument setup"""
+    return ';'.join([SYSTEM.status(), DISPLAY.status(), MEASURE.status(), MEASURE.immediate.get()]).split(';')
 
 def collect_current_setup(conn):
-    _system = System()
-    _display = Display()
-    _measure = Measure()
-    _label = Label()
-
-    data = {}
-
-    c = _system.device_id.get()
-    data[c] = conn.send_query().strip()
-    c = _system.installed_options.get()
-    data[c] = conn.send_query().strip()
-    c = _display.brightness.get()
-    data[c] = conn.send_query().strip()
-    c = _display.type.get()
-    data[c] = conn.send_query().strip()
-    c = _display.state.get()
-    data[c] = conn.send_query().strip()
-    c = _display.view.get()
-    data[c] = conn.send_query().strip()
-    # c = _measure.speed.get()
-    # data[c] = conn.send_query().strip()
-    c = _measure.sample_count.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.voltage_range.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.voltage_range_auto.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.dc_voltage.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.format.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.apeture_control.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.apeture_time.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.impedence_auto.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.immediate.get()
-    data[c] = conn.send_query()
-    c = _measure.voltage_digits.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.trigger_delay.get()
-    data[c] = conn.send_query().strip()
-    c = _measure.trigger_delay_auto.get()
-    data[c] = conn.send_query().strip()
-
-    return data
-
-def validate_config_value(section, key, value, valid_values=None, value_type=None):
-    """Validate configuration values"""
-    if value_type:
-        try:
-            if value_type == int:
-                return int(value)
-            elif value_type == float:
-                return float(value)
-        except ValueError:
-            raise ValueError(f"Invalid {value_type.__name__} value for [{section}] {key}: {value}")
-    
-    if valid_values and value.upper() not in [v.upper() for v in valid_values]:
-        raise ValueError(f"Invalid value for [{section}] {key}: {value}. Valid values: {', '.join(valid_values)}")
-    
-    return value
+    # All queries go out in a single write and the whole setup is read back in one round-trip
+    commands = setup_commands()
+    return map_replies(commands, conn.send_batch(commands))
+
+async def collect_current_setup_async(client):
+    """collect_current_setup() for an AsyncTelnetClient"""
+    commands = setup_commands()
+    response = await client.query(';'.join(commands))
+    return map_replies(commands, response.split(';'))
+
+
+# Builtins available to scripts in restricted mode
+_RESTRICTED_BUILTINS = {
+    'len': len,
+    'range': range,
+    'enumerate': enumerate,
+    'zip': zip,
+    'max': max,
+    'min': min,
+    'sum': sum,
+    'abs': abs,
+    'round': round,
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'list': list,
+    'dict': dict,
+    'tuple': tuple,
+    'set': set,
+    'print': print,
+    'True': True,
+    'False': False,
+    'None': None,
+}
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_script(path, mtime_ns, size):
+    """Compiled code of a script file, the modification time and size key out stale entries"""
+    with open(path, 'r') as f:
+        return compile(f.read(), path, 'exec')
+
+
+def compile_script(script_file):
+    """Compiled code of a script file, raises FileNotFoundError if it doesn't exist"""
+    try:
+        st = os.stat(script_file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Script file not found: {script_file}")
+    return _compile_script(script_file, st.st_mtime_ns, st.st_size)  # Unchanged scripts are only compiled once
 
 
-def execute_script_with_timeout(script_file, api, timeout=300, mode='restricted'):
+def execute_script_with_timeout(script_file, api, timeout=300, mode='restricted', compiled_code=None):
     """Execute a Python script with timeout and safety controls"""
     
     # Create safe namespace based on mode
     if mode == 'restricted':
-        # Minimal safe builtins
-        safe_builtins = {
-            '__builtins__': {
-                'len': len,
-                'range': range,
-                'enumerate': enumerate,
-                'zip': zip,
-                'max': max,
-                'min': min,
-                'sum': sum,
-                'abs': abs,
-                'round': round,
-                'str': str,
-                'int': int,
-                'float': float,
-                'bool': bool,
-                'list': list,
-                'dict': dict,
-                'tuple': tuple,
-                'set': set,
-                'print': print,
-                'True': True,
-                'False': False,
-                'None': None,
-            }
-        }
+        # Minimal safe builtins, copied so a script can't alter them for the next one
+        safe_builtins = {'__builtins__': dict(_RESTRICTED_BUILTINS)}
     elif mode == 'trusted':
         # Allow more builtins and some imports
         import math
@@ -655,12 +1005,9 @@ def execute_script_with_timeout(script_file, api, timeout=300, mode='restricted'
     def timeout_handler(signum, frame):
         raise TimeoutError(f"Script execution exceeded timeout of {timeout} seconds")
     
-    # Read and compile script
-    if not os.path.exists(script_file):
-        raise FileNotFoundError(f"Script file not found: {script_file}")
-    
-    with open(script_file, 'r') as f:
-        script_code = f.read()
+    # Read and compile script, unless the caller already did
+    if compiled_code is None:
+        compiled_code = compile_script(script_file)
     
     # Set timeout alarm if on Unix-like system
     if hasattr(signal, 'SIGALRM'):
@@ -668,8 +1015,7 @@ def execute_script_with_timeout(script_file, api, timeout=300, mode='restricted'
         signal.alarm(timeout)
     
     try:
-        # Compile and execute script
-        compiled_code = compile(script_code, script_file, 'exec')
+        # Execute script
         exec(compiled_code, namespace)
         
         # Look for and execute main function
@@ -695,30 +1041,64 @@ def execute_script_with_timeout(script_file, api, timeout=300, mode='restricted'
             signal.alarm(0)
             signal.signal(signal.SIGALRM, old_handler)
 
+def set_realtime_priority():
+    """Switch the process to SCHED_FIFO to reduce sampling jitter (Linux, needs CAP_SYS_NICE)"""
+    if not hasattr(os, 'sched_setscheduler'):
+        print("Warning: realtime scheduling is not supported on this platform")
+        return False
+    try:
+        priority = os.sched_get_priority_min(os.SCHED_FIFO)
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except PermissionError:
+        print("Warning: no permission for realtime scheduling, continuing with normal priority")
+        return False
+    return True
+
 def load_config(config_file):
     config = configparser.ConfigParser()
     config.read(config_file)
     return config
 
-def apply_config(config):
-    if 'Host' not in config:
+def flatten_config(config):
+    """Plain dict-of-dicts copy of a ConfigParser, so values are interpolated once instead of on every lookup"""
+    return {section: dict(config.items(section)) for section in config.sections()}
+
+def cfg_get(cfg, section, key, type_=str, default=None):
+    """Typed lookup in a flattened config, booleans accept the same words as ConfigParser.getboolean"""
+    value = cfg.get(section, {}).get(key)
+    if value is None:
+        return default
+    try:
+        if type_ is bool:
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        return type_(value)
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid {type_.__name__} value for [{section}] {key}: {value}")
+
+def apply_config(config, verbose=False):
+    cfg = flatten_config(config)
+    if 'Host' not in cfg:
         print("Error: No [Host] section in config file")
         exit(1)
     
-    host = config.get('Host', 'host', fallback='192.168.1.200')
-    port = validate_config_value('Host', 'port', 
-                                  config.get('Host', 'port', fallback='23'),
-                                  value_type=int)
-    timeout = validate_config_value('Host', 'timeout',
-                                     config.get('Host', 'timeout', fallback='10'),
-                                     value_type=int)
+    host = cfg_get(cfg, 'Host', 'host', default='192.168.1.200')
+    port = cfg_get(cfg, 'Host', 'port', int, 23)
+    timeout = cfg_get(cfg, 'Host', 'timeout', int, 10)
+    
+    sndbuf = cfg_get(cfg, 'Host', 'sndbuf', int, 0)
+    rcvbuf = cfg_get(cfg, 'Host', 'rcvbuf', int, 0)
     
     if port < 1 or port > 65535:
         raise ValueError(f"Invalid port number: {port}. Must be between 1 and 65535")
     if timeout < 1 or timeout > 300:
         raise ValueError(f"Invalid timeout: {timeout}. Must be between 1 and 300 seconds")
     
-    conn = TelnetClient(host, port, timeout)
+    if sndbuf < 0 or rcvbuf < 0:
+        raise ValueError("Socket buffer sizes must be positive (0 keeps the system default)")
+    
+    verbose = verbose or cfg_get(cfg, 'Run', 'verbose', bool, False)
+    
+    conn = TelnetClient(host, port, timeout, sndbuf, rcvbuf, verbose)
     
     try:
         conn.connect()
@@ -726,95 +1106,52 @@ def apply_config(config):
         print(f"Failed to connect: {e}")
         exit(1)
     
-    try:
-        system = System()
-        if 'System' in config:
-            if 'reset' in config['System']:
-                if config['System']['reset'].upper() == 'TRUE':
-                    system.wait.get()
-                    system.reset.get()
-                    system.wait.get()
-                    conn.send_query()
-
-        if 'Display' in config:
-            display = Display()
-            if 'brightness' in config['Display']:
-                display.brightness.set(config['Display']['brightness'])
-            if 'view' in config['Display']:
-                display.view.set(config['Display']['view'])
-            if 'state' in config['Display']:
-                display.state.set(config['Display']['state'])
-            if 'type' in config['Display']:
-                display.type.set(config['Display']['type'])
-
-        conn.send_query()
-
-        measure = Measure()
-        temperature = False
-
-        # Configure trigger if specified
-        if 'Trigger' in config:
-            trigger_source = config['Trigger'].get('source', 'IMMediate').upper()
-            if trigger_source in ['IMMEDIATE', 'EXTERNAL', 'BUS']:
-                measure.trigger_source.set(trigger_source)
-            
-            if 'delay' in config['Trigger']:
-                delay = float(config['Trigger']['delay'])
-                if 0 <= delay <= 9.999:
-                    measure.trigger_delay.set(delay)
-                else:
-                    raise ValueError(f"Trigger delay {delay} out of range (0-9.999 seconds)")
-            
-            if 'delay_auto' in config['Trigger']:
-                auto = config['Trigger']['delay_auto'].upper()
-                if auto in ['ON', 'OFF', '1', '0']:
-                    measure.trigger_delay_auto.set(auto)
-            
-            conn.send_query()
-
-        if 'Measure' in config:
-            if 'voltage_range' in config['Measure']:
-                measure.voltage_range.set(config['Measure']['voltage_range'])
-            if 'voltage_range_auto' in config['Measure']:
-                measure.voltage_range_auto.set(config['Measure']['voltage_range_auto'])
-            if 'speed' in config['Measure']:
-                measure.speed.set(config['Measure']['speed'])
-            if 'sample_count' in config['Measure']:
-                measure.sample_count.set(config['Measure']['sample_count'])
-            if 'format' in config['Measure']:
-                measure.format.set(config['Measure']['format'])
-            if 'continuous' in config['Measure']:
-                measure.continuous.set(config['Measure']['continuous'])
-            if 'impedence_auto' in config['Measure']:
-                measure.impedence_auto.set(config['Measure']['impedence_auto'])
-            if 'temperature' in config['Measure']:
-                if config['Measure']['temperature'].strip().upper() == 'ON':
-                    temperature = True
-            conn.send_query()
-
-        if 'Panel' in config:
-            panel = Panel()
-            if 'load' in config['Panel']:
-                panel.load(config['Panel']['load'])
-                conn.send_query()
-            elif 'save' in config['Panel']:
-                panel.save(config['Panel']['save'])
-                conn.send_query()
-
-        if 'Label' in config:
-            label = Label()
-            if 'state' in config['Label']:
-                label.label_state.set(config['Label']['state'])
-            if 'text' in config['Label']:
-                label.set_text(config['Label']['text'])
-            conn.send_query()
-
-        if 'IO' in config:
-            io = ExternalIO()
+    with conn:
+        # Nothing below waits for a reply until the IO output is set, let the kernel coalesce the writes
+        conn.begin_batch()
+        system = SYSTEM
+        if cfg_get(cfg, 'System', 'reset', bool, False):
+            conn.enqueue(system.wait.get())
+            conn.enqueue(system.reset.get())
+            conn.enqueue(system.wait.get())
+
+        if 'Trigger' in cfg:
+            cfg['Trigger'].setdefault('source', 'IMMediate')  # An empty [Trigger] section selects IMMediate
+        for section, key, control, validator in _CONFIG_MAP:
+            value = cfg.get(section, {}).get(key)
+            if value is not None and validator:
+                value = validator(value)
+            if value is not None:
+                conn.enqueue(control.set(value))
+
+        measure = MEASURE
+        temperature = cfg_get(cfg, 'Measure', 'temperature', bool, False)  # Accepts ON/OFF
+
+        if 'Panel' in cfg:
+            panel = PANEL
+            if 'load' in cfg['Panel']:
+                conn.enqueue(panel.load(cfg['Panel']['load']))
+            elif 'save' in cfg['Panel']:
+                conn.enqueue(panel.save(cfg['Panel']['save']))
+
+        if 'Label' in cfg:
+            label = LABEL
+            if 'state' in cfg['Label']:
+                conn.enqueue(label.label_state.set(cfg['Label']['state']))
+            if 'text' in cfg['Label']:
+                conn.enqueue(label.set_text(cfg['Label']['text']))
+
+        # Kept to restore the instrument if it drops the connection during the run
+        restore = [conn.q.get()] if conn.q.size else []
+        # All of the settings above are independent, send them in a single write
+        conn.flush()
+
+        if 'IO' in cfg:
+            io = EXTERNAL_IO
             
             # Set mode if specified
-            if 'mode' in config['IO']:
-                mode_value = config['IO']['mode'].upper()
+            if 'mode' in cfg['IO']:
+                mode_value = cfg['IO']['mode'].upper()
                 if mode_value in ['INPUT', 'OUTPUT', 'TRIGGER']:
                     # Note: mode might be read-only on some models
                     pass  # io.mode query only, cannot set
@@ -823,56 +1160,63 @@ def apply_config(config):
             output_value = None
             
             # Option 1: Binary string
-            if 'output_binary' in config['IO']:
+            if 'output_binary' in cfg['IO']:
                 try:
-                    output_value = int(config['IO']['output_binary'], 2)
+                    output_value = int(cfg['IO']['output_binary'], 2)
                 except ValueError:
-                    raise ValueError(f"Invalid binary value for IO output: {config['IO']['output_binary']}")
+                    raise ValueError(f"Invalid binary value for IO output: {cfg['IO']['output_binary']}")
             
             # Option 2: Decimal
-            elif 'output_decimal' in config['IO']:
+            elif 'output_decimal' in cfg['IO']:
                 try:
-                    output_value = int(config['IO']['output_decimal'])
+                    output_value = int(cfg['IO']['output_decimal'])
                 except ValueError:
-                    raise ValueError(f"Invalid decimal value for IO output: {config['IO']['output_decimal']}")
+                    raise ValueError(f"Invalid decimal value for IO output: {cfg['IO']['output_decimal']}")
             
             # Option 3: Individual bits
-            elif any(f'bit_{i}' in config['IO'] for i in range(11)):
-                output_value = 0
-                for i in range(11):
-                    bit_key = f'bit_{i}'
-                    if bit_key in config['IO']:
-                        if config['IO'][bit_key].upper() in ['ON', '1', 'TRUE']:
-                            output_value |= (1 << i)
+            elif any(k in cfg['IO'] for k in BIT_KEYS):
+                output_value = sum(1 << i for i, k in enumerate(BIT_KEYS) if _truthy(cfg['IO'].get(k)))
             
             # Apply output value if specified
             if output_value is not None:
                 if 0 <= output_value <= 2047:
-                    Q.put(f':IO:OUTPut {output_value}', False)
-                    conn.send_query()
+                    conn.write(io.output.set(output_value))
+                    restore.append(io.output.set(output_value))
                 else:
                     raise ValueError(f"IO output value {output_value} out of range (0-2047)")
 
+        conn.end_batch()
+
         # Check for script execution
-        if 'Script' in config and config['Script'].get('enabled', 'false').upper() == 'TRUE':
-            script_file = config['Script'].get('file')
-            if script_file and os.path.exists(script_file):
+        if cfg_get(cfg, 'Script', 'enabled', bool, False):
+            script_file = cfg['Script'].get('file')
+            try:
+                # Compiling also checks the file is there, instead of a separate exists() test
+                compiled_code = compile_script(script_file) if script_file else None
+            except FileNotFoundError:
+                compiled_code = None
+            except Exception as e:  # Syntax error, undecodable or unreadable file
+                # Reported like an error while running it, a broken script still replaces Run mode
+                print(f"Executing script: {script_file}")
+                print(f"Script error: {e}")
+                return
+            if compiled_code is not None:
                 print(f"Executing script: {script_file}")
                 
                 # Get script parameters
-                mode = config['Script'].get('mode', 'restricted').lower()
-                timeout = int(config['Script'].get('timeout', '300'))
+                mode = cfg['Script'].get('mode', 'restricted').lower()
+                timeout = cfg_get(cfg, 'Script', 'timeout', int, 300)
                 
                 # Create API instance
                 api = RestrictedAPI(conn, measure, system)
                 
                 try:
                     # Execute script
-                    results = execute_script_with_timeout(script_file, api, timeout, mode)
+                    results = execute_script_with_timeout(script_file, api, timeout, mode, compiled_code)
                     print(f"Script completed. {len(api.results)} measurements collected.")
                     
                     # Save results if requested
-                    if config['Script'].get('save_results', 'true').upper() == 'TRUE':
+                    if cfg_get(cfg, 'Script', 'save_results', bool, True):
                         output_file = api.save_results()
                         print(f"Script results saved to: {output_file}")
                     
@@ -886,89 +1230,157 @@ def apply_config(config):
             else:
                 print(f"Warning: Script file not found: {script_file}")
 
-        if 'Run' in config:
-            samples = int(config['Run'].get('samples', 10))
-            rate = float(config['Run'].get('polling_rate', 1))
+        if 'Run' in cfg:
+            samples = cfg_get(cfg, 'Run', 'samples', int, 10)
+            rate = cfg_get(cfg, 'Run', 'polling_rate', float, 1.0)
             output_file = '%s_HIOKI.csv' % datetime.now().strftime('%Y%m%d_%H%M%S')
-            collected_samples = 0
-            next_timestamp = datetime.now()
+            # By default 1% of the run, but never more samples than FLUSH_INTERVAL seconds worth, so a slow
+            # long run doesn't hold hours of rows in the buffer or go quiet on the console
+            default_every = min(samples // 100, int(FLUSH_INTERVAL / rate) if rate > 0 else samples)
+            # Push buffered rows to the OS every N samples
+            flush_every = max(1, cfg_get(cfg, 'Run', 'flush_every', int, default_every))
+            # Echo every sample when verbose, otherwise thinned out so the console doesn't pace fast polling
+            progress_every = max(1, cfg_get(cfg, 'Run', 'progress_every', int, 1 if verbose else default_every))
             
             # Initialize IO sequencer
             io_sequencer = IOSequencer(config)
             
             # Set initial IO state if sequencer is enabled
             if io_sequencer.enabled and io_sequencer.get_current() is not None:
-                Q.put(f':IO:OUTPut {io_sequencer.get_current()}', False)
-                conn.send_query()
+                conn.write(EXTERNAL_IO.output.set(io_sequencer.get_current()))
                 print(f"IO sequence started, initial output: {io_sequencer.get_current()}")
             
-            with open(output_file, 'a') as f:
-                if 'settings_dump' in config['Run'] and config['Run'].get('settings_dump').upper() == 'TRUE':
+            with open(output_file, 'ab', buffering=1 << 20) as f:
+                # Settings dump and CSV header go out as one write
+                preamble = []
+                if cfg_get(cfg, 'Run', 'settings_dump', bool, False):
                     current_settings = collect_current_setup(conn)
-                    for k, v in current_settings.items():
-                        f.write(f'{k}={v}\n')
+                    preamble.extend(f'{k}={v}\n' for k, v in current_settings.items())
                 
-                # Write CSV header if IO state is included
+                # CSV header if IO state is included
                 if io_sequencer.enabled and io_sequencer.include_in_csv:
-                    header = '# timestamp, measurement, io_state\n' if not temperature else '# timestamp, voltage, temperature, io_state\n'
-                    f.write(header)
+                    preamble.append('# timestamp, measurement, io_state\n' if not temperature else '# timestamp, voltage, temperature, io_state\n')
+                if preamble:
+                    f.write(''.join(preamble).encode('utf-8'))
+                
+                conn.write(system.wait.get())
+                
+                if cfg_get(cfg, 'Run', 'realtime', bool, False):
+                    set_realtime_priority()
                 
-                system.wait.get()
-                conn.send_query()
+                # The read query is identical for every sample, encode it once
+                read_sub = 'TEMP' if temperature else None
+                read_msg = measure.read.get(read_sub)
+                read_frame = measure.read.frame(read_sub)
+                # Likewise the IO output command for each pattern of the sequence
+                io_frames = {p: EXTERNAL_IO.output.set_frame(p) for p in io_sequencer.patterns}
                 
-                while collected_samples < samples:
-                    # Check if IO needs to change
-                    if io_sequencer.enabled and io_sequencer.should_change():
-                        next_io = io_sequencer.next()
-                        if next_io is not None:
-                            Q.put(f':IO:OUTPut {next_io}', False)
-                            conn.send_query()
-                            print(f"IO output changed to: {next_io}")
-                        elif io_sequencer.is_complete():
-                            print("IO sequence complete")
-                            if not io_sequencer.loop:
-                                break  # Stop if sequence is complete and not looping
+                timestamp = Timestamp()
+                io_countdown = io_sequencer.samples_per_step  # Samples left before the next IO pattern
+                pending = []  # Encoded rows not yet handed to the file
+                # Look the hot-path attributes up once, the loop body only uses locals
+                io_enabled = io_sequencer.enabled
+                io_in_csv = io_enabled and io_sequencer.include_in_csv
+                current_io = io_sequencer.current
+                # The row layout is fixed for the run, str.format ignores the IO argument when there's no column for it
+                format_row = ('{},{},{}\n' if io_in_csv else '{},{}\n').format
+                send_raw = conn.send_raw
+                stamp = timestamp.now
+                monotonic_ns = time.monotonic_ns
+                append = pending.append
+                out_write = sys.stdout.write
+                progress_fmt = (' ({}/%d) IO:{}\n' if io_enabled else ' ({}/%d)\n') % samples
+                progress_fmt = progress_fmt.format
+                # Deadlines in integer nanoseconds, exact no matter how many samples a run takes
+                rate_ns = round(rate * 1e9)
+                t0 = monotonic_ns()
+                try:
+                    for k in range(samples):
+                        # Check if IO needs to change
+                        if io_enabled:
+                            if not io_countdown:
+                                current_io = io_sequencer.advance()
+                                if current_io is None:
+                                    print("IO sequence complete")
+                                    break  # Stop if sequence is complete and not looping
+                                # Sent ahead of the sleep, so the switched circuit settles before the next reading
+                                if verbose:
+                                    print(EXTERNAL_IO.output.set(current_io))
+                                send_raw(io_frames[current_io], False)
+                                print(f"IO output changed to: {current_io}")
+                                io_countdown = io_sequencer.samples_per_step
+                            io_countdown -= 1
+                    
+                        # Sleep once until the absolute deadline of this sample, so timing errors don't accumulate
+                        delay = t0 + k * rate_ns - monotonic_ns()
+                        if delay > 0:
+                            sleep(delay / 1e9)
+                        elif delay < -rate_ns:
+                            # More than a whole period late (slow reply, reconnect), restart the schedule from here
+                            # rather than firing the missed samples back to back
+                            t0 -= delay
+                        _now = stamp()
+                        if verbose:
+                            print(read_msg)
+                        try:
+                            result = send_raw(read_frame)
+                        except ConnectionError as e:
+                            # Keep long runs going over a transient network drop, a second failure ends the run
+                            print(f"Warning: {e}, reconnecting")
+                            conn.reconnect()
+                            # A dropped connection usually means the instrument rebooted to its power-on
+                            # defaults, send the setup and the current IO pattern again
+                            for command in restore:
+                                conn.write(command)
+                            if io_enabled:
+                                send_raw(io_frames[current_io], False)
+                            append(f'# reconnected at {_now}, settings restored\n'.encode('utf-8'))
+                            result = send_raw(read_frame)
+                    
+                        line = format_row(_now, result, current_io)
+                    
+                        append(line.encode('utf-8'))
+                        if len(pending) >= CSV_BATCH or (k + 1) % flush_every == 0:
+                            f.write(b''.join(pending))
+                            pending.clear()
+                            if (k + 1) % flush_every == 0:
+                                f.flush()
                     
-                    if collected_samples == 0:
-                        _now = next_timestamp
-                    else:
-                        _now = datetime.now()
-                    if _now >= next_timestamp:
-                        next_timestamp += timedelta(seconds=rate)
-                        measure.read.get(sub='TEMP') if temperature else measure.read.get()
-                        result = conn.send_query()
-                        
-                        # Format output line with optional IO state
-                        if io_sequencer.enabled and io_sequencer.include_in_csv:
-                            current_io = io_sequencer.get_current()
-                            line = '%s,%s,%s' % (_now, result, current_io if current_io is not None else 'N/A')
-                        else:
-                            line = '%s,%s' % (_now, result)
-                        
-                        f.write(line)
-                        
                         # Print progress with IO state if enabled
-                        if io_sequencer.enabled:
-                            io_info = f" IO:{io_sequencer.get_current()}" if io_sequencer.get_current() is not None else ""
-                            print(line.strip(), '(%s/%s)%s' % (collected_samples+1, samples, io_info))
-                        else:
-                            print(line.strip(), '(%s/%s)' % (collected_samples+1, samples))
-                        
-                        collected_samples += 1
-                        io_sequencer.increment_sample()
-                    sleep(0.005)
-    finally:
-        conn.close()
+                        if (k + 1) % progress_every == 0 or k + 1 == samples:
+                            out_write(line[:-1] + progress_fmt(k + 1, current_io))
+                
+                finally:
+                    # Keep the rows collected so far, also when the run is interrupted
+                    f.write(b''.join(pending))
+                    f.flush()
+                    os.fsync(f.fileno())
 
 
-def diag(host='192.168.1.200', port=23, timeout=10):
-    """Diagnostic function for testing connections"""
-    conn = TelnetClient(host, port, timeout)
-    try:
-        conn.connect()
+def diag(host='192.168.1.200', port=23, timeout=10, conn=None):
+    """Diagnostic function for testing connections, reuses conn when one is given"""
+    if conn is not None:
         print(collect_current_setup(conn))
+        return
+    with TelnetClient(host, port, timeout) as conn:
+        print(collect_current_setup(conn))
+
+async def _diag_one(host, port, timeout):
+    client = AsyncTelnetClient(host, port, timeout)
+    await client.connect()
+    try:
+        return await collect_current_setup_async(client)
     finally:
-        conn.close()
+        await client.close()
+
+def diag_many(hosts, port=23, timeout=10):
+    """diag() for several instruments, their setups are read concurrently. Returns {host: setup or exception}"""
+    async def diag_all():
+        return await asyncio.gather(*(_diag_one(host, port, timeout) for host in hosts), return_exceptions=True)
+    results = dict(zip(hosts, run_async(diag_all())))
+    for host, result in results.items():
+        print(f"{host}: {result}")
+    return results
 
 
 if __name__ == '__main__':
@@ -976,10 +1388,11 @@ if __name__ == '__main__':
     # exit(0)
     parser = argparse.ArgumentParser(description='Run Telnet Client with config file')
     parser.add_argument('config_file', type=str, help='Path to the configuration INI file', default='config.ini')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every SCPI command sent to the instrument')
     args = parser.parse_args()
     config = load_config(args.config_file)
     # config = load_config('config.ini')
-    apply_config(config)
+    apply_config(config, args.verbose)
 
 
 
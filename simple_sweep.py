@@ -26,11 +26,15 @@ def sequence(api):
         # Take 5 measurements
         measurements = api.measure(5, delay_ms=50)
         
-        # Calculate and display average
-        valid = [m for m in measurements if m is not None]
-        if valid:
-            avg = sum(valid) / len(valid)
-            api.log(f"  Average: {avg:.3f}V from {len(valid)} samples")
+        # Calculate and display average in one pass, skipping failed readings
+        total = 0.0
+        count = 0
+        for m in measurements:
+            if m is not None:
+                total += m
+                count += 1
+        if count:
+            api.log(f"  Average: {total / count:.3f}V from {count} samples")
         else:
             api.log("  No valid measurements")
     
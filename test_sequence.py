@@ -4,6 +4,41 @@ Example test sequence for hiokitool
 Demonstrates the scripting API capabilities
 """
 
+# Test configuration matrix
+# (io_output, voltage_range, speed, samples, description)
+_RAW_MATRIX = (
+    (0b00000000001, '10V', 'SLOW', 10, 'Channel A, 10V range, slow'),
+    (0b00000000001, '10V', 'FAST', 10, 'Channel A, 10V range, fast'),
+    (0b00000000010, '10V', 'SLOW', 10, 'Channel B, 10V range, slow'),
+    (0b00000000010, '100V', 'SLOW', 5, 'Channel B, 100V range, slow'),
+    (0b00000000100, '100V', 'MED', 10, 'Channel C, 100V range, medium'),
+    (0b00000001000, '1000V', 'SLOW', 5, 'Channel D, 1000V range, slow'),
+)
+
+# Same steps with their metadata key appended, built once when the script is loaded
+TEST_MATRIX = tuple((io, vrange, speed, samples, description, f'test_{io:011b}_{vrange}')
+                    for io, vrange, speed, samples, description in _RAW_MATRIX)
+
+
+def summarize(values):
+    """Count, mean, max and min of the valid readings in one pass, None if there are none"""
+    count = 0
+    total = 0.0
+    max_val = min_val = None
+    for v in values:
+        if v is None:
+            continue
+        count += 1
+        total += v
+        if max_val is None or v > max_val:
+            max_val = v
+        if min_val is None or v < min_val:
+            min_val = v
+    if not count:
+        return None
+    return count, total / count, max_val, min_val
+
+
 def sequence(api):
     """Main sequence function called by hiokitool"""
     
@@ -14,19 +49,8 @@ def sequence(api):
     
     api.log("Starting multi-range characterization test")
     
-    # Test configuration matrix
-    test_matrix = [
-        # (io_output, voltage_range, speed, samples, description)
-        (0b00000000001, '10V', 'SLOW', 10, 'Channel A, 10V range, slow'),
-        (0b00000000001, '10V', 'FAST', 10, 'Channel A, 10V range, fast'),
-        (0b00000000010, '10V', 'SLOW', 10, 'Channel B, 10V range, slow'),
-        (0b00000000010, '100V', 'SLOW', 5, 'Channel B, 100V range, slow'),
-        (0b00000000100, '100V', 'MED', 10, 'Channel C, 100V range, medium'),
-        (0b00000001000, '1000V', 'SLOW', 5, 'Channel D, 1000V range, slow'),
-    ]
-    
     # Execute test matrix
-    for io, vrange, speed, samples, description in test_matrix:
+    for io, vrange, speed, samples, description, key in TEST_MATRIX:
         api.log(f"\n--- Test: {description} ---")
         
         # Configure measurement
@@ -40,16 +64,12 @@ def sequence(api):
         # Take measurements
         results = api.measure(samples, delay_ms=100)
         
-        # Check for valid results
-        valid_results = [r for r in results if r is not None]
-        if not valid_results:
+        # Calculate statistics over the valid results
+        summary = summarize(results)
+        if summary is None:
             api.log(f"WARNING: No valid measurements for {description}")
             continue
-        
-        # Calculate statistics
-        mean_val = sum(valid_results) / len(valid_results)
-        max_val = max(valid_results)
-        min_val = min(valid_results)
+        count, mean_val, max_val, min_val = summary
         
         # Display results
         api.log(f"Results: Mean={mean_val:.4f}V, Max={max_val:.4f}V, Min={min_val:.4f}V")
@@ -60,16 +80,16 @@ def sequence(api):
             api.set_range('100V')
             # Re-measure with higher range
             results_retry = api.measure(5, delay_ms=100)
-            valid_retry = [r for r in results_retry if r is not None]
-            if valid_retry:
-                api.log(f"Retry at 100V: Mean={sum(valid_retry)/len(valid_retry):.4f}V")
+            retry = summarize(results_retry)
+            if retry is not None:
+                api.log(f"Retry at 100V: Mean={retry[1]:.4f}V")
         
         # Store metadata for this measurement set
-        api.set_metadata(f'test_{io:011b}_{vrange}', {
+        api.set_metadata(key, {
             'mean': mean_val,
             'max': max_val,
             'min': min_val,
-            'samples': len(valid_results)
+            'samples': count
         })
     
     # Final statistics